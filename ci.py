@@ -5,17 +5,24 @@ __email__      = "me@adamihamza.com"
 """
 import hashlib
 import os
-import filecmp
+import sys
+import json
 import subprocess
 import argparse
 import uuid
+import zipfile
 from base64 import b64encode
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkdtemp
-from shutil import make_archive, move, copy2
+from shutil import move
 import time
+import random
+import threading
 import boto3
 import botocore
+import botocore.config
+from boto3.s3.transfer import TransferConfig
 
 # Arguments
 # ---------
@@ -29,6 +36,9 @@ parser.add_argument('--function-runtime', dest='function_runtime', required=Fals
                     help="AWS lambda function runtime (eg: python3.9)")
 parser.add_argument('--function-alias-name', dest='function_alias_name', required=False, default="latest",
                     help="AWS Lambda alias name (eg: latest)")
+parser.add_argument('--function-canary-weight', dest='function_canary_weight', required=False, type=float,
+                    default=None,
+                    help="Shift only this share of the alias traffic to the new version (eg: 0.1)")
 parser.add_argument('--function-layer-name', dest='function_layer_name', required=False,
                     help="AWS Lambda layer name (eg: demo-lambda-dependencies)")
 
@@ -52,6 +62,13 @@ parser.add_argument('--build-docker-repo', dest='build_docker_repo', required=Fa
 parser.add_argument('--build-docker-image', dest='build_docker_image', required=False, default=None,
                     help="Build custom docker image tag (if not provided, will use build-{[python|node][runtime-version]})")
 
+parser.add_argument('--build-verbose', dest='build_verbose', required=False, default=False, action='store_true',
+                    help="Stream the dependencies install output while building")
+
+parser.add_argument('--build-without-docker', dest='build_without_docker', required=False, default=False,
+                    action='store_true',
+                    help="Install python dependencies on the host with pip binary wheels for the lambda platform")
+
 args = parser.parse_args()
 
 # Validation
@@ -70,6 +87,27 @@ elif function_runtime.startswith("nodejs"):
 else:
     raise Exception("Unsupported lambda runtime, only python and nodejs are supported for now!")
 
+if args.function_canary_weight is not None and not 0 < args.function_canary_weight < 1:
+    raise Exception("Canary weight should be between 0 and 1 exclusive!")
+
+if args.build_without_docker and LANGUAGE != "python":
+    raise Exception("Building without docker is only supported for python runtimes!")
+
+
+# Output
+# ------
+output_lock = threading.Lock()
+
+
+def log(message):
+    """
+    Print a status line in a single write, pipeline steps run concurrently and print() splits the newline
+    :param message: the status line
+    """
+    with output_lock:
+        sys.stdout.write(f"{message}\n")
+        sys.stdout.flush()
+
 
 # Clients
 # -------
@@ -81,8 +119,10 @@ def retry_decorator(f):
             try:
                 return f(*args, **kwargs)
             except lam.exceptions.ResourceConflictException:
-                print("⌛\tLambda update is still in progress, retry in 3 seconds!")
-                time.sleep(3)
+                # Exponential backoff with jitter, starting at 300ms
+                delay = min(0.3 * 2 ** t, 5.0) + random.uniform(0, 0.3)
+                log(f"⌛\tLambda update is still in progress, retry in {delay:.1f} seconds!")
+                time.sleep(delay)
                 continue
         else:
             raise Exception("Max retries exceeded when trying to update lambda!")
@@ -90,9 +130,24 @@ def retry_decorator(f):
     return wrapper
 
 
-s3 = boto3.resource("s3")
-lam = boto3.client("lambda")
+# Room for concurrent multipart transfers and lambda calls, adaptive retries on throttling
+client_config = botocore.config.Config(
+    max_pool_connections=32,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+)
+s3 = boto3.resource("s3", config=client_config)
+lam = boto3.client("lambda", config=client_config)
+# Multipart, multi-threaded transfers for dependencies/application distributions
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
 setattr(lam, 'update_function_code', retry_decorator(lam.update_function_code))
+# Layers and code are deployed concurrently, configuration update may conflict with the code update
+setattr(lam, 'update_function_configuration', retry_decorator(lam.update_function_configuration))
 setattr(lam, 'publish_version', retry_decorator(lam.publish_version))
 
 # Utils
@@ -107,28 +162,36 @@ FUNCTION_NAME = args.function_name
 FUNCTION_RUNTIME = args.function_runtime
 FUNCTION_ALIAS_NAME = args.function_alias_name
 FUNCTION_LAYER_NAME = args.function_layer_name
-FUNCTION_LATEST_CONFIG = lam.get_function(FunctionName=FUNCTION_NAME, Qualifier=FUNCTION_ALIAS_NAME)["Configuration"]
-FUNCTION_REGION = FUNCTION_LATEST_CONFIG["FunctionArn"].split(":")[3]
-FUNCTION_LATEST_VERSION = FUNCTION_LATEST_CONFIG["Version"]
-FUNCTION_LATEST_CODE_SHA = FUNCTION_LATEST_CONFIG["CodeSha256"]
-FUNCTION_LATEST_LAYERS = FUNCTION_LATEST_CONFIG.get("Layers", [])
-FUNCTION_CURRENT_GIT_VERSION = FUNCTION_LATEST_CONFIG["Description"] if FUNCTION_LATEST_CONFIG else "Virgin"
-FUNCTION_LATEST_LAYER_CONFIG = lam.list_layer_versions(LayerName=FUNCTION_LAYER_NAME, MaxItems=1)["LayerVersions"]
-FUNCTION_LATEST_LAYER_VERSION = FUNCTION_LATEST_LAYER_CONFIG[0]["Version"] if FUNCTION_LATEST_LAYER_CONFIG else 0
-FUNCTION_LAYER_CURRENT_GIT_VERSION = FUNCTION_LATEST_LAYER_CONFIG[0][
-    "Description"] if FUNCTION_LATEST_LAYER_CONFIG else "Virgin"
+FUNCTION_CANARY_WEIGHT = args.function_canary_weight
 
 # Bucket
 APP_BUCKET = args.app_s3_bucket
 APP_S3_KEY_PREFIX = f"lambda-ci/{FUNCTION_NAME}"
+PACKAGES_DESCRIPTOR_S3_KEY = f"{APP_S3_KEY_PREFIX}/latest/{DESCRIPTORS[LANGUAGE]}"
+
+# Lambda state, loaded from AWS by load_lambda_state()
+FUNCTION_LATEST_CONFIG = None
+FUNCTION_REGION = None
+FUNCTION_LATEST_VERSION = None
+FUNCTION_LATEST_CODE_SHA = None
+FUNCTION_LATEST_LAYERS = None
+FUNCTION_ARCHITECTURE = None
+FUNCTION_CURRENT_GIT_VERSION = None
+FUNCTION_LATEST_LAYER_CONFIG = None
+FUNCTION_LATEST_LAYER_VERSION = None
+FUNCTION_LAYER_CURRENT_GIT_VERSION = None
+CACHED_PACKAGES_DESCRIPTOR_FUTURE = None
+FUNCTION_DEPLOYED_CODE_SHAS = None
 
 # Paths
 os.makedirs("/tmp/lambda-ci/", exist_ok=True)
 WORKING_DIR = mkdtemp(prefix="/tmp/lambda-ci/")
-PACKAGES_DESCRIPTOR_S3_KEY = f"{APP_S3_KEY_PREFIX}/latest/{DESCRIPTORS[LANGUAGE]}"
 CURRENT_PACKAGES_DESCRIPTOR_PATH = args.app_packages_descriptor_path
-PREVIOUS_PACKAGES_DESCRIPTOR_PATH = f"{WORKING_DIR}/prev-{DESCRIPTORS[LANGUAGE]}"
 APP_SRC_PATH = args.app_src_path
+APP_SRC_TREE_SHA = None
+# Not hashed, they do not affect the application behavior (still archived, as before)
+APP_SRC_HASH_IGNORED_DIRS = ("__pycache__", ".git")
+HASH_CACHE_PATH = "/tmp/lambda-ci/hashcache.json"
 
 # Lambda Version
 SOURCE_VERSION = args.source_version
@@ -137,24 +200,38 @@ APP_VERSION_S3_KEY = f"{VERSION_S3_KEY}/app.zip"
 DEP_VERSION_S3_KEY = f"{VERSION_S3_KEY}/deps.zip"
 APP_LATEST_S3_KEY = f"{APP_S3_KEY_PREFIX}/latest/app.zip"
 DEP_LATEST_S3_KEY = f"{APP_S3_KEY_PREFIX}/latest/deps.zip"
-APP_CURRENT_S3_KEY = f"{APP_S3_KEY_PREFIX}/{FUNCTION_CURRENT_GIT_VERSION}/app.zip"
-DEP_CURRENT_S3_KEY = f"{APP_S3_KEY_PREFIX}/{FUNCTION_LAYER_CURRENT_GIT_VERSION}/deps.zip"
+APP_TREE_SHA_S3_KEY = f"{APP_S3_KEY_PREFIX}/latest/tree.sha256"
+APP_CURRENT_S3_KEY = None
+DEP_CURRENT_S3_KEY = None
 
 # Internals
 APP_ZIP_FILENAME = f"{WORKING_DIR}/app"
 DEP_ZIP_FILENAME = f"{WORKING_DIR}/deps"
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+MAX_WORKERS = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+# Fastest zlib level, most of the archiving time is spent compressing
+ZIP_COMPRESS_LEVEL = 1
 
 # Build repo
 BUILD_DOCKER_REPO = args.build_docker_repo
 BUILD_DOCKER_IMAGE = args.build_docker_image
+BUILD_WITHOUT_DOCKER = args.build_without_docker
+BUILD_VERBOSE = args.build_verbose
+BUILD_PLATFORMS = {
+    "x86_64": "manylinux2014_x86_64",
+    "arm64": "manylinux2014_aarch64",
+}
 
-COL_BLU = "\033[94m"
-COL_GRN = "\033[92m"
-COL_YEL = "\033[93m"
-COL_MAG = "\033[95m"
-COL_CYN = "\033[96m"
-COL_WHT = "\033[97m"
-COL_END = "\033[0m"
+# No ANSI escapes when the output is piped to a CI log file
+IS_TTY = sys.stdout.isatty()
+COL_BLU = "\033[94m" if IS_TTY else ""
+COL_GRN = "\033[92m" if IS_TTY else ""
+COL_YEL = "\033[93m" if IS_TTY else ""
+COL_MAG = "\033[95m" if IS_TTY else ""
+COL_CYN = "\033[96m" if IS_TTY else ""
+COL_WHT = "\033[97m" if IS_TTY else ""
+COL_END = "\033[0m" if IS_TTY else ""
 
 
 #####################################################
@@ -169,9 +246,9 @@ def build():
     deps_changed = True
 
     # CHECK IF FIRST BUILD OR DEPENDENCIES HAVE BEEN CHANGED
-    found_cache = get_cached_package_descriptor()
-    if found_cache:
-        deps_changed = application_dependencies_changed()
+    cached_descriptor = get_cached_package_descriptor()
+    if cached_descriptor is not None:
+        deps_changed = application_dependencies_changed(cached_descriptor)
 
     # Force Rebuild deps if there is no Layer attached to the lambda
     if not FUNCTION_LATEST_LAYERS:
@@ -182,9 +259,18 @@ def build():
         fetch_dependencies()
         package_dependencies_dist()
 
+    # CHECK IF APPLICATION SOURCES HAVE BEEN CHANGED BEFORE PACKAGING THEM
+    global APP_SRC_TREE_SHA
+    APP_SRC_TREE_SHA = application_tree_sha()
+    if not application_tree_changed():
+        return deps_changed, False
+
     # FETCH/PACKAGE APP
     package_app_dist()
-    code_changed = application_code_changed()
+    local_code_sha = b64encode(file_digest(f"{APP_ZIP_FILENAME}.zip")).decode("utf-8")
+    code_changed = application_code_changed(local_code_sha)
+    if not code_changed:
+        cache_application_tree_sha(local_code_sha)
 
     return deps_changed, code_changed
 
@@ -195,10 +281,14 @@ def push(deps_changed, code_changed):
     :param deps_changed: if True push dependencies distribution
     :param code_changed: if True push code distribution
     """
-    if deps_changed:
-        push_dependencies()
-    if code_changed:
-        push_application()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        if deps_changed:
+            futures.append(executor.submit(push_dependencies))
+        if code_changed:
+            futures.append(executor.submit(push_application))
+        for future in futures:
+            future.result()
 
 
 def deploy(deps_changed, code_changed):
@@ -207,63 +297,97 @@ def deploy(deps_changed, code_changed):
     :param deps_changed: if True deploy dependencies distribution
     :param code_changed: if True deploy code distribution
     """
-    layer_version = None
-    if deps_changed:
-        # DEPLOY NEW DEPENDENCIES
-        print(f"🏗️\t{COL_MAG}Deploying{COL_END} dependencies...")
-        resp = lam.publish_layer_version(
-            LayerName=FUNCTION_LAYER_NAME,
-            Description=SOURCE_VERSION,
-            Content={
-                'S3Bucket': APP_BUCKET,
-                'S3Key': DEP_VERSION_S3_KEY,
-            },
-            CompatibleRuntimes=[FUNCTION_RUNTIME],
-        )
-        layer_version = resp["Version"]
-        layer_version_arn = resp["LayerVersionArn"]
-        lam.update_function_configuration(
-            FunctionName=FUNCTION_NAME,
-            Layers=[
-                layer_version_arn,
-            ],
-        )
-        print("✅\tDependencies deployed!")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        deps_future = executor.submit(deploy_dependencies) if deps_changed else None
+        code_future = executor.submit(deploy_application) if code_changed else None
+        if code_future:
+            code_future.result()
+        return deps_future.result() if deps_future else None
 
-        print(f"🧷\t{COL_CYN}Caching{COL_END} package descriptor...")
-        s3.meta.client.upload_file(CURRENT_PACKAGES_DESCRIPTOR_PATH, APP_BUCKET, PACKAGES_DESCRIPTOR_S3_KEY)
-        print("✅\tPackage descriptor cached!")
 
-    if code_changed:
-        # DEPLOY NEW APPLICATION
-        print(f"🏗️\t{COL_MAG}Deploying{COL_END} application...")
-        lam.update_function_code(
-            FunctionName=FUNCTION_NAME,
-            S3Bucket=APP_BUCKET,
-            S3Key=APP_VERSION_S3_KEY,
-        )
-        print("✅\tApplication deployed!")
+def deploy_dependencies():
+    """
+    Publish new layer version from the pushed dependencies and attach it to the lambda
+    :return: the published layer version
+    """
+    log(f"🏗️\t{COL_MAG}Deploying{COL_END} dependencies...")
+    resp = lam.publish_layer_version(
+        LayerName=FUNCTION_LAYER_NAME,
+        Description=SOURCE_VERSION,
+        Content={
+            'S3Bucket': APP_BUCKET,
+            'S3Key': DEP_VERSION_S3_KEY,
+        },
+        CompatibleRuntimes=[FUNCTION_RUNTIME],
+    )
+    layer_version = resp["Version"]
+    layer_version_arn = resp["LayerVersionArn"]
+    wait_function_updated()
+    lam.update_function_configuration(
+        FunctionName=FUNCTION_NAME,
+        Layers=[
+            layer_version_arn,
+        ],
+    )
+    log("✅\tDependencies deployed!")
+
+    log(f"🧷\t{COL_CYN}Caching{COL_END} package descriptor...")
+    s3.meta.client.upload_file(CURRENT_PACKAGES_DESCRIPTOR_PATH, APP_BUCKET, PACKAGES_DESCRIPTOR_S3_KEY,
+                               Config=transfer_config)
+    log("✅\tPackage descriptor cached!")
     return layer_version
 
 
+def deploy_application():
+    """
+    Update lambda code from the pushed application distribution
+    """
+    log(f"🏗️\t{COL_MAG}Deploying{COL_END} application...")
+    wait_function_updated()
+    resp = lam.update_function_code(
+        FunctionName=FUNCTION_NAME,
+        S3Bucket=APP_BUCKET,
+        S3Key=APP_VERSION_S3_KEY,
+    )
+    log("✅\tApplication deployed!")
+
+    cache_application_tree_sha(resp["CodeSha256"])
+
+
 def publish():
     """
     Publish new lambda version and shift traffic to it
     """
     # Publish
     print(f"🚢\t{COL_GRN}Publishing{COL_END} application...")
+    wait_function_updated()
     lambda_published_version = lam.publish_version(
         FunctionName=FUNCTION_NAME,
         Description=SOURCE_VERSION,
     )["Version"]
     print("✅\tApplication published!")
     # Shift
-    print(f"📌\t{COL_GRN}Shifting{COL_END} traffic to new published version...")
+    canary = FUNCTION_CANARY_WEIGHT and lambda_published_version != FUNCTION_LATEST_VERSION
+    if canary and FUNCTION_LATEST_VERSION == "$LATEST":
+        # Weighted routing needs a published primary version, the alias can not keep $LATEST
+        print("⚠️\tAlias targets $LATEST, shifting all traffic instead of canary!")
+        canary = False
+    if canary:
+        # Keep the current version as primary and route a share of the traffic to the new one
+        print(f"📌\t{COL_GRN}Shifting{COL_END} {FUNCTION_CANARY_WEIGHT:.0%} of traffic to new published version...")
+        function_version = FUNCTION_LATEST_VERSION
+        routing_weights = {lambda_published_version: FUNCTION_CANARY_WEIGHT}
+    else:
+        print(f"📌\t{COL_GRN}Shifting{COL_END} traffic to new published version...")
+        function_version = lambda_published_version
+        routing_weights = {}
     lam.update_alias(
         FunctionName=FUNCTION_NAME,
         Name=FUNCTION_ALIAS_NAME,
-        FunctionVersion=lambda_published_version,
+        FunctionVersion=function_version,
         Description=SOURCE_VERSION,
+        # Always set, so a full shift clears any previous canary routing
+        RoutingConfig={'AdditionalVersionWeights': routing_weights},
     )
     print("🎉\tHallelujah! application deployed and published successfully.")
     return lambda_published_version
@@ -273,33 +397,83 @@ def publish():
 # UTILS
 ########
 
+# State
+# -----
+def load_lambda_state():
+    """
+    Fetch lambda state and cached packages descriptor concurrently, only when the pipeline runs
+    """
+    global FUNCTION_LATEST_CONFIG, FUNCTION_REGION, FUNCTION_LATEST_VERSION, FUNCTION_LATEST_CODE_SHA, \
+        FUNCTION_LATEST_LAYERS, FUNCTION_ARCHITECTURE, FUNCTION_CURRENT_GIT_VERSION, FUNCTION_LATEST_LAYER_CONFIG, \
+        FUNCTION_LATEST_LAYER_VERSION, FUNCTION_LAYER_CURRENT_GIT_VERSION, CACHED_PACKAGES_DESCRIPTOR_FUTURE, \
+        APP_CURRENT_S3_KEY, DEP_CURRENT_S3_KEY, FUNCTION_DEPLOYED_CODE_SHAS
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        function_config_future = executor.submit(
+            lam.get_function, FunctionName=FUNCTION_NAME, Qualifier=FUNCTION_ALIAS_NAME)
+        alias_config_future = executor.submit(
+            lam.get_alias, FunctionName=FUNCTION_NAME, Name=FUNCTION_ALIAS_NAME)
+        layer_config_future = executor.submit(
+            lam.list_layer_versions, LayerName=FUNCTION_LAYER_NAME, MaxItems=1)
+        CACHED_PACKAGES_DESCRIPTOR_FUTURE = executor.submit(
+            s3.meta.client.get_object, Bucket=APP_BUCKET, Key=PACKAGES_DESCRIPTOR_S3_KEY)
+
+    FUNCTION_LATEST_CONFIG = function_config_future.result()["Configuration"]
+    FUNCTION_REGION = FUNCTION_LATEST_CONFIG["FunctionArn"].split(":")[3]
+    FUNCTION_LATEST_VERSION = FUNCTION_LATEST_CONFIG["Version"]
+    FUNCTION_LATEST_CODE_SHA = FUNCTION_LATEST_CONFIG["CodeSha256"]
+    FUNCTION_LATEST_LAYERS = FUNCTION_LATEST_CONFIG.get("Layers", [])
+    FUNCTION_ARCHITECTURE = FUNCTION_LATEST_CONFIG.get("Architectures", ["x86_64"])[0]
+    FUNCTION_CURRENT_GIT_VERSION = FUNCTION_LATEST_CONFIG["Description"] if FUNCTION_LATEST_CONFIG else "Virgin"
+    FUNCTION_LATEST_LAYER_CONFIG = layer_config_future.result()["LayerVersions"]
+    FUNCTION_LATEST_LAYER_VERSION = FUNCTION_LATEST_LAYER_CONFIG[0]["Version"] if FUNCTION_LATEST_LAYER_CONFIG else 0
+    FUNCTION_LAYER_CURRENT_GIT_VERSION = FUNCTION_LATEST_LAYER_CONFIG[0][
+        "Description"] if FUNCTION_LATEST_LAYER_CONFIG else "Virgin"
+
+    APP_CURRENT_S3_KEY = f"{APP_S3_KEY_PREFIX}/{FUNCTION_CURRENT_GIT_VERSION}/app.zip"
+    DEP_CURRENT_S3_KEY = f"{APP_S3_KEY_PREFIX}/{FUNCTION_LAYER_CURRENT_GIT_VERSION}/deps.zip"
+
+    # Code behind the alias, including the canary versions it routes traffic to
+    FUNCTION_DEPLOYED_CODE_SHAS = {FUNCTION_LATEST_CODE_SHA}
+    canary_versions = alias_config_future.result().get("RoutingConfig", {}).get("AdditionalVersionWeights", {})
+    for canary_version in canary_versions:
+        canary_config = lam.get_function(FunctionName=FUNCTION_NAME, Qualifier=canary_version)["Configuration"]
+        FUNCTION_DEPLOYED_CODE_SHAS.add(canary_config["CodeSha256"])
+
+
 # Check
 # -----
-def key_exist(key):
+def wait_function_updated():
+    """
+    Poll the lambda until its last update is done, instead of blindly retrying on ResourceConflictException
+    """
+    if "function_updated_v2" not in lam.waiter_names:
+        return
     try:
-        s3.Object(APP_BUCKET, key).load()
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            return False
-        else:
-            raise
-    return True
+        lam.get_waiter("function_updated_v2").wait(
+            FunctionName=FUNCTION_NAME,
+            WaiterConfig={'Delay': 1, 'MaxAttempts': 30},
+        )
+    except botocore.exceptions.WaiterError:
+        # Failed or still in progress updates are left to the retry decorator
+        pass
 
 
 def get_cached_package_descriptor():
     print(f"👀\t{COL_WHT}Checking{COL_END} if package descriptor cache exist on S3...")
-    if key_exist(PACKAGES_DESCRIPTOR_S3_KEY):
-        print("✅\tRemote packages descriptor found!")
-        s3.Bucket(APP_BUCKET).download_file(PACKAGES_DESCRIPTOR_S3_KEY, PREVIOUS_PACKAGES_DESCRIPTOR_PATH)
-        return PREVIOUS_PACKAGES_DESCRIPTOR_PATH
-    else:
+    try:
+        resp = CACHED_PACKAGES_DESCRIPTOR_FUTURE.result()
+    except s3.meta.client.exceptions.NoSuchKey:
         print("❌\tRemote packages descriptor not found, no cache - dependencies will be updated")
         return None
+    print("✅\tRemote packages descriptor found!")
+    return resp["Body"].read()
 
 
-def application_dependencies_changed():
+def application_dependencies_changed(cached_descriptor):
     print(f"📐️\t{COL_CYN}Comparing{COL_END} cached packages descriptor with new packages descriptor...")
-    not_changed = filecmp.cmp(PREVIOUS_PACKAGES_DESCRIPTOR_PATH, CURRENT_PACKAGES_DESCRIPTOR_PATH)
+    with open(CURRENT_PACKAGES_DESCRIPTOR_PATH, 'rb') as f:
+        not_changed = f.read() == cached_descriptor
     if not_changed:
         print("✅\tDependencies didn't change, skipping dependencies update!")
         return False
@@ -308,66 +482,235 @@ def application_dependencies_changed():
         return True
 
 
-def application_code_changed():
-    print(f"📐️\t{COL_CYN}Comparing{COL_END} latest code sha with local code sha...")
-    with open(f"{APP_ZIP_FILENAME}.zip", 'rb') as f:
-        local_code = f.read()
-        m = hashlib.sha256()
-        m.update(local_code)
-        s3_digest = m.digest()
-        local_code_sha = b64encode(s3_digest).decode("utf-8")
-        if local_code_sha == FUNCTION_LATEST_CODE_SHA:
-            print("✅\tCode hash didn't change, skipping code update!")
-            return False
+def application_tree_sha():
+    """
+    Hash the application sources tree from entries paths, permissions, sizes and contents
+    :return: the tree sha256 hex digest
+    """
+    hash_cache = load_hash_cache()
+    entries = []
+    seen_paths = set()
+    for entry in scan_tree(APP_SRC_PATH, exclude=APP_SRC_HASH_IGNORED_DIRS):
+        rel_path = os.path.relpath(entry.path, APP_SRC_PATH)
+        stat = entry.stat()
+        # Permission bits are stored in the zip too, eg: executable bootstrap
+        mode = stat.st_mode & 0o777
+        if entry.is_dir():
+            entries.append((f"{rel_path}/", mode, 0, ""))
         else:
-            print("❌\tCode hash changed, code will be updated!")
-            return True
+            seen_paths.add(os.path.abspath(entry.path))
+            entries.append((rel_path, mode, stat.st_size, cached_file_sha(hash_cache, entry.path, stat)))
+    save_hash_cache(hash_cache, seen_paths)
+    m = hashlib.sha256()
+    for rel_path, mode, size, sha in sorted(entries):
+        m.update(f"{rel_path}\0{mode:o}\0{size}\0{sha}\n".encode("utf-8"))
+    return m.hexdigest()
+
+
+def cached_file_sha(hash_cache, path, stat):
+    """
+    Reuse the file sha from the hash cache if the file mtime and size did not change
+    :param hash_cache: dict of absolute path to [mtime_ns, size, sha256]
+    :param path: the file path
+    :param stat: the file stat result
+    :return: the file sha256 hex digest
+    """
+    abs_path = os.path.abspath(path)
+    cached = hash_cache.get(abs_path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    sha = file_digest(path).hex()
+    hash_cache[abs_path] = [stat.st_mtime_ns, stat.st_size, sha]
+    return sha
+
+
+def load_hash_cache():
+    try:
+        with open(HASH_CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hash_cache(hash_cache, seen_paths):
+    # Forget files removed from the sources, the cache is shared by every function and checkout
+    src_prefix = os.path.join(os.path.abspath(APP_SRC_PATH), "")
+    hash_cache = {
+        path: cached for path, cached in hash_cache.items()
+        if path in seen_paths or not path.startswith(src_prefix)
+    }
+    # Write then rename, so concurrent runs never read a partially written cache
+    tmp_path = f"{HASH_CACHE_PATH}.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(hash_cache, f)
+    os.replace(tmp_path, HASH_CACHE_PATH)
+
+
+def application_tree_changed():
+    print(f"📐️\t{COL_CYN}Comparing{COL_END} cached sources tree sha with local sources tree sha...")
+    try:
+        resp = s3.meta.client.get_object(Bucket=APP_BUCKET, Key=APP_TREE_SHA_S3_KEY)
+    except s3.meta.client.exceptions.NoSuchKey:
+        print("❌\tRemote sources tree sha not found, application will be packaged")
+        return True
+    cached_tree_sha = resp["Body"].read().decode("utf-8")
+    # The cached tree is only valid while the code it was deployed with is still behind the alias
+    cached_code_sha = resp["Metadata"].get("code-sha256")
+    if cached_tree_sha == APP_SRC_TREE_SHA and cached_code_sha in FUNCTION_DEPLOYED_CODE_SHAS:
+        print("✅\tSources tree didn't change, skipping code packaging and update!")
+        return False
+    else:
+        print("❌\tSources tree changed, application will be packaged")
+        return True
+
+
+def cache_application_tree_sha(code_sha):
+    log(f"🧷\t{COL_CYN}Caching{COL_END} sources tree sha...")
+    s3.meta.client.put_object(
+        Bucket=APP_BUCKET,
+        Key=APP_TREE_SHA_S3_KEY,
+        Body=APP_SRC_TREE_SHA.encode("utf-8"),
+        Metadata={"code-sha256": code_sha},
+    )
+    log("✅\tSources tree sha cached!")
+
+
+def application_code_changed(local_code_sha):
+    print(f"📐️\t{COL_CYN}Comparing{COL_END} latest code sha with local code sha...")
+    if local_code_sha in FUNCTION_DEPLOYED_CODE_SHAS:
+        print("✅\tCode hash didn't change, skipping code update!")
+        return False
+    else:
+        print("❌\tCode hash changed, code will be updated!")
+        return True
+
+
+def file_digest(path, algorithm="sha256"):
+    """
+    Hash a file by chunks without loading it entirely into memory
+    :param path: the file path
+    :param algorithm: hashlib algorithm name
+    :return: the file digest bytes
+    """
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+
+            return hashlib.file_digest(f, algorithm).digest()
+        m = hashlib.new(algorithm)
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            m.update(view[:size])
+        return m.digest()
+
+
+def scan_tree(top, exclude=()):
+    """
+    Walk a tree the way make_archive does: directories and regular files, symlinked directories are not followed
+    scandir entries carry their type, no extra stat per entry to tell directories from files
+    :param top: the directory to walk
+    :param exclude: directories names to skip
+    :return: generator of os.DirEntry
+    """
+    dirs = [top]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if entry.name in exclude:
+                        continue
+                    yield entry
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                elif entry.is_file():
+                    # Broken symlinks, fifos, sockets... are skipped
+                    yield entry
 
 
 # Install
 # -------
 def fetch_dependencies():
     print(f"🧲\t{COL_YEL}Fetching{COL_END} dependencies...")
-    descriptor = copy2(CURRENT_PACKAGES_DESCRIPTOR_PATH, f"{WORKING_DIR}/current-{DESCRIPTORS[LANGUAGE]}")
-    descriptor = os.path.basename(descriptor)
+    descriptor = os.path.abspath(CURRENT_PACKAGES_DESCRIPTOR_PATH)
     if LANGUAGE == "python":
         pip(descriptor)
     elif LANGUAGE == "nodejs":
-        npm()
+        npm(descriptor)
         move(f"{WORKING_DIR}/node_modules", f"{WORKING_DIR}/nodejs/node_modules")
     print("✅\tDependencies installed!")
 
 
 def pip(descriptor):
-    install_cmd = f"pip3 install -r {descriptor} -t python/lib/{FUNCTION_RUNTIME}/site-packages"
-    docker_run(install_cmd)
+    if BUILD_WITHOUT_DOCKER:
+        host_pip(descriptor)
+        return
+    install_cmd = f"pip3 install -r {DESCRIPTORS[LANGUAGE]} -t python/lib/{FUNCTION_RUNTIME}/site-packages"
+    docker_run(install_cmd, descriptor)
+
 
+def host_pip(descriptor):
+    """
+    Install lambda platform binary wheels with the host pip, no docker container startup or image pull
+    :param descriptor: the requirements file absolute path
+    """
+    install_cmd = [
+        sys.executable, "-m", "pip", "install", "-r", descriptor,
+        "-t", f"python/lib/{FUNCTION_RUNTIME}/site-packages",
+        "--platform", BUILD_PLATFORMS[FUNCTION_ARCHITECTURE],
+        "--implementation", "cp",
+        "--python-version", FUNCTION_RUNTIME[len("python"):],
+        "--only-binary=:all:",
+    ]
+    run_build_cmd(install_cmd, cwd=WORKING_DIR)
 
-def npm():
-    install_cmd = f"npm install"
-    docker_run(install_cmd)
 
+def npm(descriptor):
+    install_cmd = "npm install"
+    docker_run(install_cmd, descriptor)
 
-def docker_run(install_cmd):
+
+def docker_run(install_cmd, descriptor):
+    """
+    Run the install command in the build container, with the packages descriptor mounted read-only
+    :param install_cmd: the shell install command
+    :param descriptor: the packages descriptor absolute path
+    """
     if BUILD_DOCKER_IMAGE:
         image_tag = BUILD_DOCKER_IMAGE
     else:
         image_tag = f"build-{FUNCTION_RUNTIME}"
-    docker_cmd = (
-        "docker", "run", f'-v "{WORKING_DIR}":/var/task',
-        f"--rm {BUILD_DOCKER_REPO}:{image_tag}",
-        f'/bin/sh -c "{install_cmd}"'
-    )
-    try:
-        with open(f"/tmp/{SOURCE_VERSION}-deps.log", 'w') as output:
-            subprocess.check_call(
-                " ".join(docker_cmd),
-                shell=True,
-                stdout=output,
-                stderr=subprocess.STDOUT
-            )
-    except subprocess.CalledProcessError:
-        print(open(f"/tmp/{SOURCE_VERSION}-deps.log", 'r').read())
+    docker_cmd = [
+        "docker", "run", "-v", f"{WORKING_DIR}:/var/task",
+        "-v", f"{descriptor}:/var/task/{DESCRIPTORS[LANGUAGE]}:ro",
+        "--rm", f"{BUILD_DOCKER_REPO}:{image_tag}",
+        "/bin/sh", "-c", install_cmd,
+    ]
+    run_build_cmd(docker_cmd)
+
+
+def run_build_cmd(cmd, **kwargs):
+    """
+    Run the dependencies install command, tee its output to the build log and, if verbose, to stdout
+    :param cmd: the command argv
+    """
+    log_path = f"/tmp/{SOURCE_VERSION}-deps.log"
+    with open(log_path, 'wb') as output:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        for line in proc.stdout:
+            output.write(line)
+            if BUILD_VERBOSE:
+                sys.stdout.buffer.write(line)
+                sys.stdout.flush()
+        proc.stdout.close()
+        return_code = proc.wait()
+    if return_code:
+        if not BUILD_VERBOSE:
+            # Output was not streamed, show it on failure
+            with open(log_path, 'r') as output:
+                print(output.read())
         exit(1)
 
 
@@ -375,37 +718,113 @@ def docker_run(install_cmd):
 # -------
 def package_dependencies_dist():
     print(f"📦\t{COL_YEL}Packaging{COL_END} dependencies...")
-    make_archive(DEP_ZIP_FILENAME, "zip", WORKING_DIR, LANGUAGE)
+    archive(f"{DEP_ZIP_FILENAME}.zip", WORKING_DIR, LANGUAGE)
     print("✅\tDependencies distribution ready!")
 
 
 def package_app_dist():
     print(f"📦\t{COL_YEL}Packaging{COL_END} app...")
-    make_archive(APP_ZIP_FILENAME, "zip", APP_SRC_PATH)
+    archive(f"{APP_ZIP_FILENAME}.zip", APP_SRC_PATH)
     print("✅\tApp distribution ready!")
 
 
+def archive(zip_path, root_dir, base_dir=os.curdir):
+    """
+    Zip base_dir relative to root_dir, the same layout as shutil.make_archive but with fast compression
+    :param zip_path: the zip file path
+    :param root_dir: the directory archive paths are relative to
+    :param base_dir: the directory to archive, relative to root_dir
+    """
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL) as zf:
+        top = os.path.join(root_dir, base_dir)
+        if os.path.normpath(base_dir) != os.curdir:
+            zf.write(top, os.path.normpath(base_dir))
+        for entry in scan_tree(top):
+            zf.write(entry.path, os.path.normpath(os.path.relpath(entry.path, root_dir)))
+
+
 # Push
 # ----
 def push_dependencies():
-    print(f"🚀\t{COL_BLU}Pushing{COL_END} dependencies distribution to S3...")
-    s3.meta.client.upload_file(f"{DEP_ZIP_FILENAME}.zip", APP_BUCKET, DEP_LATEST_S3_KEY)
-    s3.meta.client.upload_file(f"{DEP_ZIP_FILENAME}.zip", APP_BUCKET, DEP_VERSION_S3_KEY)
-    print("✅\tDependencies distribution pushed!")
+    log(f"🚀\t{COL_BLU}Pushing{COL_END} dependencies distribution to S3...")
+    push_distribution(f"{DEP_ZIP_FILENAME}.zip", DEP_VERSION_S3_KEY, DEP_LATEST_S3_KEY)
+    log("✅\tDependencies distribution pushed!")
 
 
 def push_application():
-    print(f"🚀\t{COL_BLU}Pushing{COL_END} application distribution to S3...")
-    s3.meta.client.upload_file(f"{APP_ZIP_FILENAME}.zip", APP_BUCKET, APP_LATEST_S3_KEY)
-    s3.meta.client.upload_file(f"{APP_ZIP_FILENAME}.zip", APP_BUCKET, APP_VERSION_S3_KEY)
-    print("✅\tApplication distribution pushed!")
+    log(f"🚀\t{COL_BLU}Pushing{COL_END} application distribution to S3...")
+    push_distribution(f"{APP_ZIP_FILENAME}.zip", APP_VERSION_S3_KEY, APP_LATEST_S3_KEY)
+    log("✅\tApplication distribution pushed!")
+
+
+def push_distribution(local_path, version_key, latest_key):
+    """
+    Push a distribution to its versioned key and latest key, reusing latest if it is the same distribution
+    :param local_path: the local distribution path
+    :param version_key: versioned S3 key, unique per run
+    :param latest_key: latest S3 key, shared by runs
+    """
+    local_sha = file_digest(local_path).hex()
+    etag = matching_distribution_etag(local_path, local_sha, latest_key)
+    if etag:
+        try:
+            # Fails if another run replaced latest since it was checked
+            copy_key(local_path, latest_key, version_key, if_match=etag)
+            log("✅\tSame distribution already on S3, skipping upload!")
+            return
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ("PreconditionFailed", "412"):
+                raise
+    # Versioned key is unique per run, latest is copied from it so concurrent pipelines never mix artifacts
+    s3.meta.client.upload_file(local_path, APP_BUCKET, version_key, ExtraArgs={"Metadata": {"sha256": local_sha}},
+                               Config=transfer_config)
+    copy_key(local_path, version_key, latest_key)
+
+
+def matching_distribution_etag(local_path, local_sha, key):
+    """
+    :return: the ETag of the S3 object if it is the same distribution, None otherwise
+    """
+    try:
+        resp = s3.meta.client.head_object(Bucket=APP_BUCKET, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            return None
+        else:
+            raise
+    etag = resp["ETag"]
+    remote_sha = resp["Metadata"].get("sha256")
+    if remote_sha:
+        return etag if remote_sha == local_sha else None
+    # Objects pushed without sha256 metadata, the ETag is the MD5 only for single part uploads
+    md5 = etag.strip('"')
+    if "-" in md5:
+        return None
+    return etag if md5 == file_digest(local_path, "md5").hex() else None
+
+
+def copy_key(local_path, src_key, dst_key, if_match=None):
+    """
+    Server side copy of an already pushed distribution instead of uploading it twice
+    :param local_path: the local distribution that was pushed to src_key
+    :param src_key: source S3 key
+    :param dst_key: destination S3 key
+    :param if_match: only copy if the source ETag still matches
+    """
+    copy_source = {'Bucket': APP_BUCKET, 'Key': src_key}
+    extra_args = {'CopySourceIfMatch': if_match} if if_match else {}
+    if os.path.getsize(local_path) > MAX_COPY_OBJECT_SIZE:
+        # copy_object is limited to 5GB, fallback to managed multipart copy
+        s3.meta.client.copy(copy_source, APP_BUCKET, dst_key, ExtraArgs=extra_args, Config=transfer_config)
+    else:
+        s3.meta.client.copy_object(Bucket=APP_BUCKET, Key=dst_key, CopySource=copy_source, **extra_args)
 
 
 def summary(lambda_version, layer_version,
             code_changed=False, deps_changed=False):
     lam_url = f"https://console.aws.amazon.com/lambda/home?region={FUNCTION_REGION}#"
     artifacts_location = f"https://s3.console.aws.amazon.com/s3/buckets/{args.app_s3_bucket}?prefix="
-    link = f"\u001b]8;;%s\u001b\\See on aws console\u001b]8;;\u001b\\"
+    link = "\u001b]8;;%s\u001b\\See on aws console\u001b]8;;\u001b\\" if IS_TTY else "%s"
 
     function_version_url = link % f"{lam_url}/functions/{FUNCTION_NAME}/versions/{lambda_version}?tab=code"
     function_layer_url = link % f"{lam_url}/layers/{FUNCTION_LAYER_NAME}/versions/{layer_version}"
@@ -435,18 +854,16 @@ def summary(lambda_version, layer_version,
     code_s3_url = link % f"{artifacts_location}{current_code_s3_key.replace('/', '%2F')}"
     deps_s3_url = link % f"{artifacts_location}{current_deps_s3_key.replace('/', '%2F')}"
 
-    print("\nCurrently published:")
-    print("====================")
-    print(
-        f"{COL_YEL}Lambda:{COL_END} {function_version_url} [{state}{lambda_state}, {version}{COL_MAG}{lambda_version}{COL_END}]")
-    print(
-        f"{COL_YEL}Layer:{COL_END}  {function_layer_url} [{state}{layer_state}, {version}{COL_MAG}{layer_version}{COL_END}]")
-    print("\nArtifacts:")
-    print("===========")
-    print(
-        f"{COL_YEL}Source code:{COL_END}  {code_s3_url} [{state}{code_state}, {version}{COL_MAG}{current_code_version}{COL_END}]")
-    print(
-        f"{COL_YEL}Dependencies:{COL_END} {deps_s3_url} [{state}{deps_state}, {version}{COL_MAG}{current_deps_version}{COL_END}]")
+    print(f"""
+Currently published:
+====================
+{COL_YEL}Lambda:{COL_END} {function_version_url} [{state}{lambda_state}, {version}{COL_MAG}{lambda_version}{COL_END}]
+{COL_YEL}Layer:{COL_END}  {function_layer_url} [{state}{layer_state}, {version}{COL_MAG}{layer_version}{COL_END}]
+
+Artifacts:
+===========
+{COL_YEL}Source code:{COL_END}  {code_s3_url} [{state}{code_state}, {version}{COL_MAG}{current_code_version}{COL_END}]
+{COL_YEL}Dependencies:{COL_END} {deps_s3_url} [{state}{deps_state}, {version}{COL_MAG}{current_deps_version}{COL_END}]""")
 
     if args.watch_log_stream:
         print("\nWatching lambda cloudwatch log stream...")
@@ -464,6 +881,7 @@ def summary(lambda_version, layer_version,
 
 
 def ci():
+    load_lambda_state()
     logo = f"""{COL_YEL}
                 __    ___    __  _______  ____  ___       __________
                / /   /   |  /  |/  / __ )/ __ \/   |     / ____/  _/
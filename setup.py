@@ -15,7 +15,7 @@ setup(
         "boto3",
         "awslogs"
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     entry_points={
         'console_scripts': [
             'aws-lambda-ci = ci:ci',